@@ -0,0 +1,595 @@
+#!/usr/bin/env python
+#
+# benchmark.py:
+# Time the fetch, parse and post paths of each bot against fixed source pages
+#
+# Source pages are served from a local HTTP server and posts go to a dummy
+# Polybot, so nothing leaves the machine. Pages are generated unless a
+# directory of recorded ones is given with --fixtures, containing any of
+# secgen.html, upcoming.json, passsummary.html and forecast.json. The server
+# gives each page an ETag and answers a matching If-None-Match with a 304.
+#
+# Run with --save to store the results as the baseline; later runs fail if
+# any stage is more than --threshold slower than its baseline.
+
+import argparse
+import hashlib
+import http.server
+import json
+import logging
+import os
+import statistics
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import tracemalloc
+import types
+import urllib.parse
+import arrow
+from dateutil import tz
+
+# The bots read their settings from config.py
+sys.modules.setdefault('config', types.ModuleType('config')).__dict__.update(
+    LATITUDE=52.48, LONGITUDE=-1.89, ALTITUDE=140, FORECASTIO_KEY='key', SHOWS={'show': 'b0000001'})
+
+import cbeebies  # noqa: E402
+import iss  # noqa: E402
+import secgen  # noqa: E402
+import outbox  # noqa: E402
+from bot import Event, SchedulerBot, write_file  # noqa: E402
+try:
+    import isspredict
+except ImportError:  # Needs numpy and sgp4
+    isspredict = None
+
+# Time posting, not the spacing between posts
+outbox.Outbox.default_interval = 0
+
+SECGEN_ROWS = [
+    ('9:00 a.m.', 'Meeting with <strong>H.E. Mr. Juan Pérez</strong>, President of the Republic of X'),
+    ('10.30 a.m.', 'Secretary-General to address the <em>General&nbsp;Assembly</em>'),
+    ('11:15 a.m.', 'Remarks by the Secretary-General at UNICEF &amp; Partners event'),
+    ('12 noon', '<p>Drop by at the photo exhibit</p>'),
+    ('1:30', 'Luncheon hosted by the Secretary-General for the members of the Security Council'),
+    ('3 p.m.', 'His Excellency Mr. John Smith, Minister of Foreign Affairs of Y'),
+    ('4:00 p.m.', 'Permanent Representatives of the Group of 77 &quot;Chairs&quot;'),
+    ('5:45', 'The Security Council to hear a briefing by the Secretary-General on Syria'),
+    ('6 p.m.', 'SECURITY COUNCIL OF THE UNITED NATIONS reception'),
+]
+
+# What prettify() made of each of these before its rules became one table,
+# one or more for every rule; any change to the rules must keep them
+PRETTIFY_GOLDEN = [
+    ('approx. Meeting with H.E. Mr. Juan Pérez, President of the Republic of X',
+     'Meeting with H.E. Mr. Juan Pérez, President of the Republic of X'),
+    ('Meeting on Climate Change (The Secretary-General will make remarks)',
+     'Making remarks at the Meeting on Climate Change'),
+    ('Visit to the UNITED NATIONS Headquarters', 'Visit to the United Nations Headquarters'),
+    ('Chairing of the Executive Committee', 'Chairing the Executive Committee'),
+    ('Joint press encounter by the Secretary-General with: the President of France',
+     'Joint press encounter with the President of France'),
+    ('Joint Declaration on Cooperation by the Secretary-General and the Prime Minister of Y',
+     'Joint Declaration on Cooperation with the Prime Minister of Y'),
+    ('The Secretary-General to address the General Assembly', 'Addressing the General Assembly'),
+    ('Secretary-General will make his remarks at the Summit', 'Making my remarks at the Summit'),
+    ('Secretary-General to attend the Opening Ceremony', 'Attending the Opening Ceremony'),
+    ('Luncheon hosted by the Secretary-General for the members of the Security Council',
+     'Hosting Luncheon for the members of the Security Council'),
+    ('Secretary-General to host a dinner', 'Hosting a dinner'),
+    ('The Secretary-General departs for Geneva', 'Departing for Geneva'),
+    ('Secretary-General to brief the press', 'Briefing the press'),
+    ('The Security Council to hear a briefing by the Secretary-General on Syria',
+     'Briefing a The Security Council on Syria'),
+    ('Secretary-General&rsquo;s briefing to the Member States', 'Briefing to the Member States'),
+    ('Secretary-General to speak at the University', 'Speaking at the University'),
+    ('Secretary-General to speak to the media', 'Speaking to the media'),
+    ('Secretary-General to deliver the Lecture', 'Delivering the Lecture'),
+    ('Secretary-General will hold a press conference', 'Holding a press conference'),
+    ('Secretary-General to give an interview', 'Giving an interview'),
+    ('Drop by at the photo exhibit', 'Dropping by the photo exhibit'),
+    ('Remarks by the Secretary-General at UNICEF &amp; Partners event',
+     'Making remarks at Unicef &amp; Partners event'),
+    ('SG remarks at the Gala', 'Making remarks at the Gala'),
+    ('Welcoming Remarks to the Delegates', 'Making remarks to the Delegates'),
+    ('Addressing the High-Level Event - The Secretary-General to make opening remarks.',
+     'Addressing the High-Level Event - The Secretary-General to make opening remarks.'),
+    ('High-Level Event on Oceans [Secretary-General to deliver remarks]',
+     'Making remarks at the High-Level Event on Oceans'),
+    ('The Ocean Conference (Secretary-General to make closing remarks)',
+     'Making closing remarks at The Ocean Conference'),
+    ('[Remarks at] the Ceremony', 'Making remarks at the Ceremony'),
+    ('Presentation of credentials', 'Presentation of credentials'),
+    ('Remarks at the ceremony', 'Remarks at the ceremony'),
+    ('Election of the President', 'Election of the President'),
+    ('Swearing-in Ceremony', 'Swearing-in Ceremony'),
+    ('Permanent Representatives of the Group of 77', 'Meeting the Permanent Representatives of the Group of 77'),
+    ('Permanent Representatives of the Group of 77 luncheon',
+     'Attending the Permanent Representatives of the Group of 77 luncheon'),
+    ('Sages Group', 'Meeting the Sages Group'),
+    ('Meeting of the Youth', 'Attending the Meeting of the Youth'),
+    ('His Excellency Mr. John Smith, Minister of Foreign Affairs of Y',
+     'Meeting His Excellency Mr. John Smith, Minister of Foreign Affairs of Y'),
+    ('Amb. Jane Doe', 'Attending the Amb. Jane Doe'),
+    ('Amb Jane Doe', 'Attending the Amb Jane Doe'),
+    ('President of the General Assembly luncheon', 'Attending the President of the General Assembly luncheon'),
+    ('Delegation of the European Parliament', 'Meeting the Delegation of the European Parliament'),
+    ('Members of the Joint Staff Meeting', 'Attending the Members of the Joint Staff Meeting'),
+    ('Special Representative for Children and Armed Conflict',
+     'Meeting Special Representative for Children and Armed Conflict'),
+    ('Senior Adviser at a conference', 'Attending the Senior Adviser at a conference'),
+    ('The Elders', 'Meeting The Elders'),
+    ('Annual ceremony', 'Attending the Annual ceremony'),
+    ('SECURITY COUNCIL OF THE UNITED NATIONS reception',
+     'Attending the Security Council of The United Nations reception'),
+    ('Secretery-General to brief the Council', 'Briefing the Council'),
+    ('General Assembly debate', 'Attending the General Assembly debate'),
+]
+
+
+# The (time, status) of each event the BeautifulSoup parser, before the
+# streaming one replaced it, found in secgen_page()
+SECGEN_GOLDEN = [
+    ('2018-09-25T09:00:00-04:00', 'Meeting with H.E. Mr. Juan Pérez, President of the Republic of X'),
+    ('2018-09-25T10:30:00-04:00', 'Addressing the General Assembly'),
+    ('2018-09-25T11:15:00-04:00', 'Making remarks at Unicef & Partners event'),
+    ('2018-09-25T12:00:00-04:00', 'Dropping by the photo exhibit'),
+    ('2018-09-25T13:30:00-04:00', 'Hosting Luncheon for the members of the Security Council'),
+    ('2018-09-25T15:00:00-04:00', 'Meeting His Excellency Mr. John Smith, Minister of Foreign Affairs of Y'),
+    ('2018-09-25T16:00:00-04:00', 'Meeting the Permanent Representatives of the Group of 77 "Chairs"'),
+    ('2018-09-25T17:45:00-04:00', 'Briefing a The Security Council on Syria'),
+    ('2018-09-25T18:00:00-04:00', 'Attending the Security Council of The United Nations reception'),
+]
+
+
+def secgen_page(days=1):
+    out = ['<!DOCTYPE html><html><head><title>Appointments of the Secretary-General</title>',
+           '<script>var menu = "<tr><td>9 am</td></tr>";</script></head><body>',
+           '<div class="nav"><ul>%s</ul></div>' % ''.join(
+               '<li><a href="/sg/en/%d">Link %d</a></li>' % (i, i) for i in range(300)),
+           '<div class="view view-schedules"><div class="view-header">',
+           '<span class="date-display-single" content="2018-09-25T00:00:00-04:00">Tuesday, 25 September</span>',
+           '</div><div class="view-content"><table class="views-table"><tbody>']
+    for day in range(days):
+        for when, what in SECGEN_ROWS:
+            out.append('<tr>\n<td class="views-field">%s</td>\n<td class="views-field">\n%s\n</td>\n</tr>' % (
+                when, what))
+    out.append('</tbody></table></div></div>')
+    out.append('<div class="footer">%s</div></body></html>' % ('<p>Footer text</p>' * 200))
+    return '\n'.join(out)
+
+
+def upcoming_json(count=100):
+    start = arrow.utcnow().replace(minute=0, second=0, microsecond=0)
+    broadcasts = []
+    for i in range(count):
+        broadcasts.append({
+            'start': start.shift(minutes=20 * i).isoformat(),
+            'programme': {
+                'title': 'Show', 'position': i % 40 + 1, 'short_synopsis': 'Something happens in episode %d.' % i,
+                'programme': {'position': i // 40 + 1}, 'image': {'pid': 'p%07d' % i},
+            },
+        })
+    return json.dumps({'broadcasts': broadcasts})
+
+
+def passsummary_page(count=30):
+    day = arrow.now().shift(days=1)
+    out = ['<html><body><table class="standardTable">']
+    for i in range(count):
+        date = day.shift(hours=13 * i)
+        out.append(
+            '<tr class="clickableRow" onclick="window.location=\'passdetails.aspx\'">'
+            '<td><a href="passdetails.aspx?satid=25544" title="Click to see details">%s</a></td>'
+            '<td align="center">-2.%d</td><td>%s</td><td>10°</td><td>SW</td><td>%s</td><td>45°</td><td>S</td>'
+            '<td>%s</td><td>10°</td><td>ENE</td><td>visible</td></tr>' % (
+                date.format('DD MMM'), i % 10, date.format('HH:mm:ss'), date.shift(minutes=3).format('HH:mm:ss'),
+                date.shift(minutes=6).format('HH:mm:ss')))
+    out.append('</table></body></html>')
+    return '\n'.join(out)
+
+
+def forecast_json():
+    return json.dumps({'currently': {'summary': 'Partly Cloudy', 'temperature': 12.3, 'cloudCover': 0.4}})
+
+
+JPEG = b'\xff\xd8' + b'\0' * 8000
+
+ISS_TLE = ['1 25544U 98067A   08264.51782528 -.00002182  00000-0 -11606-4 0  2927',
+           '2 25544  51.6416 247.4627 0006703 130.5360 325.0288 15.72125391563537']
+ISS_TLE_EPOCH = 1221868800  # Predict from around when the TLE was made
+
+
+class Fixtures(object):
+    def __init__(self, directory=None):
+        self.pages = {
+            'secgen.html': secgen_page(),
+            'upcoming.json': upcoming_json(),
+            'passsummary.html': passsummary_page(),
+            'forecast.json': forecast_json(),
+        }
+        for name in self.pages:
+            if directory and os.path.exists(os.path.join(directory, name)):
+                self.pages[name] = open(os.path.join(directory, name)).read()
+        self.requests = []  # (path, If-None-Match sent, status) of each request
+
+    def for_path(self, path):
+        if 'appointments' in path:
+            return self.pages['secgen.html'].encode('utf-8'), 'text/html; charset=utf-8'
+        if 'upcoming.json' in path:
+            return self.pages['upcoming.json'].encode('utf-8'), 'application/json'
+        if 'PassSummary' in path:
+            return self.pages['passsummary.html'].encode('utf-8'), 'text/html; charset=utf-8'
+        if 'forecast' in path:
+            return self.pages['forecast.json'].encode('utf-8'), 'application/json'
+        if path.endswith('.jpg'):
+            return JPEG, 'image/jpeg'
+        return None, None
+
+
+def serve(fixtures):
+    class Handler(http.server.BaseHTTPRequestHandler):
+        protocol_version = 'HTTP/1.1'
+        disable_nagle_algorithm = True
+
+        def do_GET(self):
+            body, content_type = fixtures.for_path(self.path)
+            if body is None:
+                fixtures.requests.append((self.path, None, 404))
+                self.send_error(404)
+                return
+            etag = '"%s"' % hashlib.sha1(body).hexdigest()
+            sent = self.headers.get('If-None-Match')
+            if sent == etag:
+                fixtures.requests.append((self.path, sent, 304))
+                self.send_response(304)
+                self.send_header('ETag', etag)
+                self.send_header('Content-Length', '0')
+                self.end_headers()
+                return
+            fixtures.requests.append((self.path, sent, 200))
+            self.send_response(200)
+            self.send_header('Content-Type', content_type)
+            self.send_header('Content-Length', str(len(body)))
+            self.send_header('ETag', etag)
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, *args):
+            pass
+
+    server = http.server.ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+class LocalSession(object):
+    """Stands in for a requests session, sending every request to the local server."""
+
+    def __init__(self, port):
+        import requests
+        self.session = requests.Session()
+        self.port = port
+
+    def get(self, url, **kwargs):
+        u = urllib.parse.urlsplit(url)
+        url = urllib.parse.urlunsplit(('http', '127.0.0.1:%d' % self.port, u.path, u.query, ''))
+        return self.session.get(url, **kwargs)
+
+
+class DummyService(object):
+    name = 'Dummy'
+
+    def __init__(self):
+        self.posts = []
+
+    def post(self, status, **kwargs):
+        self.posts.append(status)
+
+
+class SlowService(DummyService):
+    """A service taking latency seconds to post, failing the first failures
+    tries, or every one if failures is None."""
+
+    def __init__(self, name, latency=0.01, failures=0):
+        super().__init__()
+        self.name = name
+        self.latency = latency
+        self.failures = failures
+        self.tries = 0
+
+    def post(self, status, **kwargs):
+        time.sleep(self.latency)
+        self.tries += 1
+        if self.failures is None or self.tries <= self.failures:
+            raise IOError('%s is down' % self.name)
+        super().post(status, **kwargs)
+
+
+def check_outbox(datadir):
+    """Check that overlapping runs post each item once to every service, and
+    that a failing service is retried, backing off, and then given up on."""
+    poster = make_bot(SchedulerBot, 'outbox')
+    poster.log = logging.getLogger('benchmark.outbox')
+    poster.log.setLevel('CRITICAL')
+    filename = os.path.join(datadir, 'outbox-check')
+    items = [('id%d' % i, 'Status %d' % i, None) for i in range(5)]
+
+    fast, flaky = SlowService('Fast'), SlowService('Flaky', failures=2)
+    poster.polybot.services = [fast, flaky]
+    runs = [outbox.Outbox(poster, filename) for i in range(2)]
+    for run in runs:
+        run.backoff = 0.01
+    threads = [threading.Thread(target=run.send, args=(items,)) for run in runs]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    statuses = [i[1] for i in items]
+    assert fast.posts == statuses, 'Fast was sent %r' % fast.posts
+    assert flaky.posts == statuses and flaky.tries == len(items) + 2, 'Flaky was sent %r' % flaky.posts
+
+    down = SlowService('Down', failures=None)
+    poster.polybot.services = [down]
+    run = outbox.Outbox(poster, filename)
+    run.retries, run.backoff = 3, 0.05
+    start = time.time()
+    run.send(items[:1])
+    assert down.tries == 3 and not down.posts, 'Down was tried %d times' % down.tries
+    assert time.time() - start >= 0.05 + 0.1, 'No backoff between tries'
+    assert ('id0', 'Down') not in run.read(), 'Failed post recorded as sent'
+
+
+class DummyPolybot(object):
+    def __init__(self):
+        self.services = [DummyService()]
+        self.args = argparse.Namespace(live=False, interactive=False)
+
+
+def make_bot(cls, *args):
+    argv = sys.argv
+    sys.argv = [argv[0], 'post']
+    try:
+        bot = cls(*args)
+    finally:
+        sys.argv = argv
+    bot.log.setLevel('WARNING')
+    bot.polybot = DummyPolybot()
+    return bot
+
+
+def check_conditional(bot, fixtures):
+    """Check that fetching an unchanged schedule again sends its ETag, gets a
+    304 and leaves the saved schedule alone, and that a changed one is saved
+    along with its new ETag."""
+    schedule = bot.localfile % bot.name
+    digest = '%s-digest' % schedule
+    page = fixtures.pages['secgen.html']
+    etag = '"%s"' % hashlib.sha1(page.encode('utf-8')).hexdigest()
+    assert bot.fetch(), 'First fetch not saved'
+    assert [v.get('ETag') for v in bot.get_validators().values()] == [etag], 'ETag not saved'
+    saved = [(open(f, 'rb').read(), os.stat(f).st_mtime_ns) for f in (schedule, digest)]
+    assert not bot.fetch(), 'Unchanged schedule fetched as changed'
+    assert fixtures.requests[-1][1:] == (etag, 304), 'Conditional fetch was %r' % (fixtures.requests[-1],)
+    assert [(open(f, 'rb').read(), os.stat(f).st_mtime_ns) for f in (schedule, digest)] == saved, \
+        'Schedule changed on a 304'
+
+    changed = fixtures.pages['secgen.html'] = page.replace('Syria', 'Yemen')
+    try:
+        assert bot.fetch(), 'Changed schedule not saved'
+        assert fixtures.requests[-1][1:] == (etag, 200), 'Changed fetch was %r' % (fixtures.requests[-1],)
+        assert open(schedule).read() == changed, 'Changed schedule not saved'
+        etag = '"%s"' % hashlib.sha1(changed.encode('utf-8')).hexdigest()
+        assert [v.get('ETag') for v in bot.get_validators().values()] == [etag], 'New ETag not saved'
+    finally:
+        fixtures.pages['secgen.html'] = page
+
+
+def stages(datadir, session, fixtures):
+    class SecgenBot(secgen.SecgenBot):
+        localfile = os.path.join(datadir, '%s-schedule')
+
+    class CBeebiesBot(cbeebies.CBeebiesBot):
+        localfile = os.path.join(datadir, '%s-schedule')
+        imagedir = os.path.join(datadir, '%s-images/')
+
+    iss.localfile = os.path.join(datadir, '%s')
+
+    sg = make_bot(SecgenBot, 'secgen')
+    cb = make_bot(CBeebiesBot, 'show')
+    sp = make_bot(iss.ISSBot, 'abovebrum', 52.48, -1.89, 140, 'key')
+    for bot in (sg, cb, sp):
+        bot.session = session
+        bot.path = os.path.join(datadir, '')
+        bot.storefile = os.path.join(datadir, 'events.db')
+
+    def fetch(bot):
+        bot.store.clear(bot.name, 'events')
+        for name in os.listdir(datadir):
+            if name.startswith(bot.name) and not os.path.isdir(os.path.join(datadir, name)):
+                os.remove(os.path.join(datadir, name))
+        bot.fetch()
+
+    # Every stage can then run on its own
+    fetch(sg)
+    fetch(cb)
+    sp.fetch()
+    sp.weather()
+    check_outbox(datadir)
+    sg_conditional = make_bot(SecgenBot, 'secgen-conditional')
+    sg_conditional.session = session
+    sg_conditional.path = sg.path
+    sg_conditional.storefile = sg.storefile
+    check_conditional(sg_conditional, fixtures)
+    sg_golden = make_bot(SecgenBot, 'secgen-golden')
+    sg_golden.parse_get_file = lambda warn=0: secgen_page()
+    assert [(e.time.isoformat(), e.status) for e in sg_golden.parse()] == SECGEN_GOLDEN, 'Parsed schedule differs'
+    sg_rows = [secgen.parsecell(row) for row in secgen.ScheduleParser().parse(secgen_page()).rows]
+    for s, expected in PRETTIFY_GOLDEN:
+        assert secgen.prettify(s) == expected, 'prettify(%r) is %r, not %r' % (s, secgen.prettify(s), expected)
+
+    # A week's schedule with a few rows changing between parses, as when
+    # the day's schedule is edited; the memo must not change what is parsed
+    week = secgen_page(7)
+    edit = [0]
+
+    def edited(warn=0):
+        edit[0] += 1
+        return week.replace('Syria', 'Syria %d' % edit[0], 3)
+
+    sg_edited = make_bot(SecgenBot, 'secgen-edited')
+    sg_edited.parse_get_file = edited
+    sg_full = make_bot(SecgenBot, 'secgen-full')
+    sg_full.memo_size = 0
+    sg_full.parse_get_file = lambda warn=0: week.replace('Syria', 'Syria %d' % edit[0], 3)
+    sg_edited.parse()
+    assert [str(e) for e in sg_edited.parse()] == [str(e) for e in sg_full.parse()], 'Memoized parse differs'
+
+    # A long schedule, an event every 30 seconds either side of now; the
+    # store's range query must find just what checking every event does
+    start = int(time.time()) - 50000 * 30
+
+    class ManyBot(SchedulerBot):
+        localfile = os.path.join(datadir, '%s-schedule')
+
+        def parse(self, warn=0):
+            return [Event(epoch=start + 30 * i, tz=tz.tzutc()) for i in range(100000)]
+
+    many = make_bot(ManyBot, 'many')
+    many.storefile = os.path.join(datadir, 'events.db')
+    write_file(many.localfile % many.name, 'many')
+    now = arrow.utcnow()
+    due = [e.epoch for e in many.alert_due(now)]
+    assert due and due == [e.epoch for e in many.parse() if many.alert(e, now)], 'alert_due differs'
+    many_passes = passsummary_page(300)
+
+    def iss_extract():
+        timestamps = iss.Timestamps()
+        return [timestamps.parse('%s %s' % (row[0], row[2])) for row in iss.pass_rows(many_passes)]
+
+    # Spread around the latitudes the ISS passes over
+    locations = [(-50 + (i * 37) % 110, -180 + (i * 71) % 360, 100) for i in range(100)]
+    predict = []
+    if isspredict:
+        for n in (1, 10, 100):
+            predict.append(('iss predict %d locations' % n,
+                            lambda n=n: isspredict.predict(ISS_TLE, locations[:n], ISS_TLE_EPOCH)))
+
+    return [
+        ('secgen fetch', lambda: fetch(sg)),
+        ('secgen parse', lambda: sg.parse()),
+        ('secgen parse cached', lambda: sg.parse_cached()),
+        ('secgen parse edited', lambda: sg_edited.parse()),
+        ('secgen parse edited full', lambda: sg_full.parse()),
+        ('secgen prettify', lambda: [secgen.prettify(row) for row in sg_rows]),
+        ('secgen post', lambda: sg.post_events(sg.parse_cached())),
+        ('secgen startup post', startup(datadir)),
+        ('cbeebies fetch', lambda: fetch(cb)),
+        ('cbeebies parse', lambda: cb.parse()),
+        ('cbeebies parse cached', lambda: cb.parse_cached()),
+        ('cbeebies alert', lambda: cb.alert_due(arrow.utcnow())),
+        ('alert due 100k events', lambda: many.alert_due(arrow.utcnow())),
+        ('cbeebies post', lambda: cb.post_events(cb.parse_cached()[:5])),
+        ('iss fetch', lambda: sp.fetch()),
+        ('iss weather', lambda: sp.weather_fetch()),
+        ('iss weather cached', lambda: sp.weather()),
+        ('iss parse', lambda: sp.parse()),
+        ('iss timestamp', lambda: iss.get_timestamp('25 Sep 19:21:13')),
+        ('iss extract 300 passes', iss_extract),
+        ('iss post', lambda: sp.post_events(sp.parse_cached()[:5])),
+    ] + predict
+
+
+# Run as "secgen.py post" does, with the bot's files in the data directory;
+# with nothing due, none of the modules only needed to post should load
+STARTUP = '''
+import sys
+import secgen
+secgen.SecgenBot.localfile = %(localfile)r
+secgen.SecgenBot.storefile = %(storefile)r
+secgen.SecgenBot.path = %(path)r
+secgen.bots()[0].run()
+heavy = {'requests', 'polybot', 'bs4'} & set(sys.modules)
+assert not heavy, 'Imported %%s with nothing to post' %% ', '.join(sorted(heavy))
+'''
+
+
+def startup(datadir):
+    """Return a function running "secgen.py post" in a new Python, with an
+    empty alert window."""
+    with open(os.path.join(datadir, 'config.py'), 'w') as fp:
+        fp.write(''.join('%s = %r\n' % item for item in sorted(vars(sys.modules['config']).items())
+                         if not item[0].startswith('__')))
+    script = STARTUP % {'localfile': os.path.join(datadir, '%s-schedule'),
+                        'storefile': os.path.join(datadir, 'events.db'), 'path': os.path.join(datadir, '')}
+    env = dict(os.environ, PYTHONPATH=os.pathsep.join([datadir, os.path.dirname(os.path.abspath(__file__))]))
+    return lambda: subprocess.run([sys.executable, '-c', script, 'post'], env=env, cwd=datadir, check=True)
+
+
+def measure(func, min_time):
+    func()  # Warm up, and fill any caches the stage relies on
+    times = []
+    start = time.perf_counter()
+    while time.perf_counter() - start < min_time or len(times) < 5:
+        t = time.perf_counter()
+        func()
+        times.append(time.perf_counter() - t)
+    tracemalloc.start()
+    func()
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    times.sort()
+    return {
+        'median': statistics.median(times),
+        'p95': times[int(len(times) * 0.95) - 1],
+        'per_second': len(times) / sum(times),
+        'peak_bytes': peak,
+    }
+
+
+def main():
+    p = argparse.ArgumentParser(description='Benchmark the fetch, parse and post paths of the bots.')
+    p.add_argument('--fixtures', metavar='DIR', help='Directory of recorded source pages to use')
+    p.add_argument('--baseline', metavar='FILE', default='benchmark-baseline.json', help='Baseline results')
+    p.add_argument('--save', action='store_true', help='Save these results as the baseline')
+    p.add_argument('--threshold', type=float, default=0.25, help='Allowed slowdown over the baseline (0.25)')
+    p.add_argument('--time', type=float, default=0.5, help='Minimum seconds to run each stage for')
+    p.add_argument('stage', nargs='*', help='Only run stages starting with these')
+    args = p.parse_args()
+
+    fixtures = Fixtures(args.fixtures)
+    server = serve(fixtures)
+    session = LocalSession(server.server_address[1])
+    results = {}
+    with tempfile.TemporaryDirectory() as datadir:
+        print('%-24s %10s %10s %10s %10s' % ('stage', 'median ms', 'p95 ms', 'per sec', 'peak KB'))
+        for name, func in stages(datadir, session, fixtures):
+            if args.stage and not any(name.startswith(s) for s in args.stage):
+                continue
+            r = results[name] = measure(func, args.time)
+            print('%-24s %10.3f %10.3f %10.1f %10.1f' % (
+                name, r['median'] * 1000, r['p95'] * 1000, r['per_second'], r['peak_bytes'] / 1024))
+    server.shutdown()
+
+    if args.save:
+        json.dump(results, open(args.baseline, 'w'), indent=2, sort_keys=True)
+        print('Saved baseline to %s' % args.baseline)
+        return 0
+
+    try:
+        baseline = json.load(open(args.baseline))
+    except IOError:
+        return 0
+    slower = []
+    for name, r in results.items():
+        if name in baseline and r['median'] > baseline[name]['median'] * (1 + args.threshold):
+            slower.append('%s: %.3fms, baseline %.3fms' % (name, r['median'] * 1000, baseline[name]['median'] * 1000))
+    if slower:
+        print('Slower than baseline:\n  ' + '\n  '.join(slower))
+        return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -7,72 +7,242 @@
 # http://www.dracos.co.uk/
 
 import argparse
+import contextlib
+import hashlib
+import heapq
+import io
+import json
+import logging
 import os
-import re
+import pickle
 import sys
-import requests
+import threading
+import time
 import arrow
-from polybot import Bot
 
 
 class Event(object):
+    """Something happening, at epoch seconds in timezone tz. Subclasses list
+    whatever else they keep in __slots__ and build anything bigger, such as
+    the status, only when asked."""
+    __slots__ = ('epoch', 'tz')
     image = None
     status = None
 
     def __init__(self, **kwargs):
-        self.__dict__.update(kwargs)
+        for k, v in kwargs.items():
+            setattr(self, k, v)
+
+    @property
+    def time(self):
+        return arrow.Arrow.fromtimestamp(self.epoch, self.tz)
+
+    @time.setter
+    def time(self, time):
+        self.epoch = int(time.timestamp())
+        self.tz = time.tzinfo
 
     def __str__(self):
         return '%s %s' % (self.time, self.status)
 
 
-class SchedulerBot(Bot):
+def write_file(filename, data):
+    """Write data (str or bytes) so that readers only ever see the old or
+    the new contents, never a partly written file."""
+    tmp = '%s.%d.%d.tmp' % (filename, os.getpid(), threading.get_ident())
+    with open(tmp, 'wb' if isinstance(data, bytes) else 'w') as fp:
+        fp.write(data)
+        fp.flush()
+        os.fsync(fp.fileno())
+    os.replace(tmp, filename)
+
+
+CODE_VERSIONS = {}
+
+
+def code_version(cls):
+    """A hash of the source of the modules defining cls and the classes it
+    is made from, which changes whenever their code does."""
+    if cls not in CODE_VERSIONS:
+        digest = hashlib.sha1()
+        for base in cls.__mro__:
+            filename = getattr(sys.modules.get(base.__module__), '__file__', None)
+            if filename and base is not object:
+                digest.update(open(filename, 'rb').read())
+        CODE_VERSIONS[cls] = digest.hexdigest()
+    return CODE_VERSIONS[cls]
+
+
+def polybot(bot):
+    """Return a Polybot bot whose main() is bot.main(). Polybot is slow to
+    import, so this only happens once there is something to post."""
+    from polybot import Bot
+
+    class PolyBot(Bot):
+        path = bot.path
+
+        def main(self):
+            bot.main()
+
+    return PolyBot(bot.name)
+
+
+def run_all(bots):
+    """Run each of bots in turn. Serving never finishes, so to serve more
+    than one bot each is run in a process of its own."""
+    if len(bots) < 2 or bots[0].scheduler_args.action != 'serve':
+        for bot in bots:
+            bot.run()
+        return
+    import multiprocessing
+    processes = [multiprocessing.Process(target=bot.run, name=bot.name) for bot in bots]
+    for process in processes:
+        process.start()
+    for process in processes:
+        process.join()
+
+
+class SchedulerBot(object):
     path = '/home/sympl/scheduler/conf/'
-    choices = ['fetch', 'post', 'test']
+    choices = ['fetch', 'fetch-auto', 'post', 'test', 'serve']
+    serve_poll = 60  # Longest sleep in serve mode, in seconds, between checks for a new schedule
+    session = None  # Set to a requests.Session to share connections between fetches
 
-    def __init__(self, name):
-        super().__init__(name)
+    def __init__(self, name, argv=None):
+        """Options are read from argv, or the command line if not given. What
+        is not for us is kept in scheduler_left, for Polybot."""
+        self.name = name
+        self.polybot = None
+        logging.basicConfig(level=logging.INFO, format='%(asctime)s [%(levelname)s] %(module)s: %(message)s')
+        self.log = logging.getLogger(__name__)
+        self.timings = []
+        self.last_timings = []  # Those of the last run, once exported
         self.scheduler_parser = p = argparse.ArgumentParser()
         p.add_argument('action', choices=self.choices,
                        help='Action to perform; one of %s' % ', '.join(self.choices))
-        self.scheduler_args, left = p.parse_known_args()
-        sys.argv[1:] = left
+        p.add_argument('--metrics-json', metavar='FILE', help='Append timings of each run to FILE as JSON lines')
+        p.add_argument('--metrics-dir', metavar='DIR',
+                       help='Write timings to DIR/scheduler_<name>_<action>.prom for Prometheus')
+        p.add_argument('--cprofile', metavar='FILE', help='Save a cProfile of the run to FILE')
+        self.scheduler_args, self.scheduler_left = p.parse_known_args(argv)
 
     def fetch(self):
-        """Fetch something external and save somewhere."""
+        """Fetch something external and save somewhere. Returns whether it
+        had changed, or None if it could not be fetched."""
         raise NotImplementedError()
 
-    def fetch_save_file(self, data):
-        f = open(self.localfile % self.name, 'w')
-        f.write(data)
-        f.close()
+    def fetch_normalize(self, data):
+        """Return data without any parts that change without the schedule changing."""
+        return data
+
+    def fetch_digest(self, data):
+        return hashlib.sha1(self.fetch_normalize(data).encode('utf-8')).hexdigest()
+
+    def fetch_saved_digest(self):
+        """Return the digest of the saved schedule, from its sidecar file if
+        there is one. A sidecar left without its schedule is ignored."""
+        if not os.path.exists(self.localfile % self.name):
+            return None
         try:
-            os.remove('%s-override' % (self.localfile % self.name))
+            return open('%s-digest' % (self.localfile % self.name)).read()
+        except IOError:
+            pass
+        try:
+            return self.fetch_digest(self.get_contents(self.localfile % self.name))
+        except FileNotFoundError:
+            return None
+
+    def fetch_save_file(self, data, digest=None):
+        write_file(self.localfile % self.name, data)
+        write_file('%s-digest' % (self.localfile % self.name), digest or self.fetch_digest(data))
+        try:
+            os.remove(self.overridefile)
         except FileNotFoundError:
             pass
+        self.store_update()
 
     def fetch_check_file(self, new):
+        if new is None or self.not_got.search(new):
+            return None
         if not new:
             return False
-        current = ''
+        with self.timed('fetch_diff'):
+            digest = self.fetch_digest(new)
+            changed = digest != self.fetch_saved_digest()
+        if changed:
+            self.fetch_save_file(new, digest)
+        return changed
+
+    # fetch-auto fetches only when a source is due a check. A source that has
+    # just changed is due every fetch_min_interval seconds, backing off by
+    # doubling while it stays the same, up to fetch_max_interval or half the
+    # usual gap between its changes. Ahead of an event it is checked more
+    # often, a quarter of the time left to go between checks. A source that
+    # could not be fetched is checked again sooner, halving the interval.
+
+    fetch_min_interval = 5 * 60
+    fetch_max_interval = 6 * 3600
+    fetch_history_size = 20  # Changes to remember
+
+    @property
+    def fetchfile(self):
+        return '%s%s.fetches' % (self.path, self.name)
+
+    def fetch_history(self):
         try:
-            current = self.get_contents(self.localfile % self.name)
-        except FileNotFoundError:
+            return json.load(open(self.fetchfile))
+        except (IOError, ValueError):
+            return {}
+
+    def fetch_interval(self, history):
+        interval = history.get('interval', self.fetch_min_interval)
+        changes = history.get('changes', [])
+        if len(changes) > 2:
+            gaps = sorted(b - a for a, b in zip(changes, changes[1:]))
+            interval = min(interval, gaps[len(gaps) // 2] / 2)
+        return max(self.fetch_min_interval, min(interval, self.fetch_max_interval))
+
+    def fetch_due(self, now=None):
+        """Return whether fetch-auto should fetch now."""
+        now = now or time.time()
+        history = self.fetch_history()
+        interval = self.fetch_interval(history)
+        upcoming = self.events_between(now, now + interval)
+        if upcoming:
+            interval = max(self.fetch_min_interval, min(interval, (upcoming[0].epoch - now) / 4))
+        return now - history.get('checked', 0) >= interval
+
+    def fetch_recorded(self):
+        """fetch(), noting when the source was checked and if it had changed
+        or could not be fetched."""
+        return self.fetch_record(self.fetch())
+
+    def fetch_record(self, changed):
+        now = time.time()
+        history = self.fetch_history()
+        if changed:
+            history['interval'] = self.fetch_min_interval
+            history['changes'] = (history.get('changes', []) + [now])[-self.fetch_history_size:]
+        elif changed is None:
+            history['interval'] = self.fetch_interval(history) / 2
+        else:
+            history['interval'] = self.fetch_interval(history) * 2
+        history['checked'] = now
+        try:
+            write_file(self.fetchfile, json.dumps(history))
+        except IOError:
             pass
-        if self.fetch_diff(current, new) and not re.search(self.not_got, new):
-            self.fetch_save_file(new)
-            return True
-        return False
+        return changed
 
     def parse_get_file(self, warn=0):
         try:
-            d = self.get_contents("%s-override" % (self.localfile % self.name))
+            d = self.get_contents(self.overridefile)
         except IOError:
             try:
                 d = self.get_contents(self.localfile % self.name)
             except IOError:
                 if warn:
-                    print('No downloaded schedule for %' % self.name)
+                    print('No downloaded schedule for %s' % self.name)
                 return None
         return d
 
@@ -80,56 +250,360 @@ class SchedulerBot(Bot):
         """Parse external thing, return list of event objects."""
         raise NotImplementedError()
 
+    # Parsed events are kept in the shared event store, recording the files
+    # parse() read them from and the version of the code that parsed them,
+    # so a run only re-parses when either changes.
+
+    storefile = '/home/sympl/scheduler/data/events.db'
+    store_hits = 0
+    store_misses = 0
+
+    @property
+    def store(self):
+        if '_store' not in self.__dict__:
+            from store import EventStore
+            self._store = EventStore(self.storefile)
+        return self._store
+
+    @property
+    def overridefile(self):
+        """A hand-edited schedule, used instead of the fetched one while it exists."""
+        return '%s-override' % (self.localfile % self.name)
+
+    def parse_files(self):
+        """Return the files parse() reads, used to spot when to re-parse."""
+        if self.overridefile and os.path.exists(self.overridefile):
+            return [self.overridefile]
+        return [self.localfile % self.name]
+
+    def parse_files_key(self, files, hashes=None):
+        key = []
+        for i, filename in enumerate(files):
+            try:
+                st = os.stat(filename)
+            except FileNotFoundError:
+                key.append((filename, None, None, None))
+                continue
+            if hashes is not None and [filename, st.st_mtime_ns, st.st_size] == hashes[i][:3]:
+                digest = hashes[i][3]
+            else:
+                digest = hashlib.sha1(open(filename, 'rb').read()).hexdigest()
+            key.append([filename, st.st_mtime_ns, st.st_size, digest])
+        return key
+
+    def store_update(self, warn=0, force=False):
+        """Bring this bot's events in the store up to date with its files,
+        re-parsing them regardless if force is set."""
+        files = self.parse_files()
+        table = 'overrides' if self.overridefile and files == [self.overridefile] else 'events'
+        if table == 'events' and self.store.key(self.name, 'overrides') is not None:
+            self.store.clear(self.name, 'overrides')
+        version = code_version(type(self))
+        key = None if force else self.store.key(self.name, table)
+        if key is not None:
+            # A matching mtime and size reuses the stored hash, otherwise the
+            # file is hashed so that a touched but unchanged file still hits.
+            key = json.loads(key)
+            if isinstance(key, dict) and key.get('version') == version:
+                key = key['files']
+                current = self.parse_files_key(files, key if len(key) == len(files) else None)
+                if [(k[0], k[3]) for k in current] == [(k[0], k[3]) for k in key]:
+                    self.store_hits += 1
+                    self.log.debug('Store up to date (%d hits, %d misses)' % (self.store_hits, self.store_misses))
+                    if current != key:
+                        self.store.set_key(self.name, table, json.dumps({'version': version, 'files': current}))
+                    return
+
+        self.store_misses += 1
+        self.log.debug('Store out of date (%d hits, %d misses)' % (self.store_hits, self.store_misses))
+        current = self.parse_files_key(files)
+        with self.timed('parse'):
+            events = self.parse(warn)
+        with self.timed('store'):
+            rows = [(e.epoch, self.summary(e), self.event_dumps(e)) for e in events]
+            self.store.replace(self.name, table, json.dumps({'version': version, 'files': current}), rows)
+
+    def summary(self, event):
+        """A line describing event, for looking through the store and telling
+        posts apart, so it must be the same on every run."""
+        return event.status
+
+    def event_dumps(self, event):
+        data = io.BytesIO()
+        pickler = pickle.Pickler(data, pickle.HIGHEST_PROTOCOL)
+        # Events may refer back to their bot; store a reference, not the bot
+        pickler.persistent_id = lambda obj: 'bot' if obj is self else None
+        pickler.dump(event)
+        return data.getvalue()
+
+    def event_loads(self, data):
+        unpickler = pickle.Unpickler(io.BytesIO(data))
+        unpickler.persistent_load = lambda pid: self
+        return unpickler.load()
+
+    def events_between(self, start=None, end=None):
+        """Return the events with start < epoch <= end, sorted by time. If
+        stored events cannot be loaded, they are parsed again."""
+        self.store_update()
+        try:
+            return [self.event_loads(event) for epoch, event in self.store.between(self.name, start, end)]
+        except (pickle.UnpicklingError, AttributeError, ImportError, EOFError, TypeError, ValueError):
+            self.log.warning('Could not load stored events, parsing again', exc_info=True)
+        self.store_update(force=True)
+        return [self.event_loads(event) for epoch, event in self.store.between(self.name, start, end)]
+
+    def parse_cached(self, warn=0):
+        """parse(), but from the store, only parsing when the files have changed."""
+        return self.events_between()
+
+    # Bots either set alert_window to (offset, duration) in minutes, posting
+    # from offset after the event's time for duration minutes, or override
+    # alert() for anything else.
+
+    alert_window = (0, 5)
+
+    def alert(self, event, now):
+        start = self.alert_start(event)
+        return now >= start and now < start.shift(minutes=self.alert_window[1])
+
+    def alert_start(self, event):
+        """Return when the alert window for event opens."""
+        return event.time.shift(minutes=self.alert_window[0])
+
+    def alert_due(self, now):
+        """Return the events due to be posted at now."""
+        if type(self).alert is not SchedulerBot.alert:
+            events = self.parse_cached()
+            with self.timed('alert'):
+                return [e for e in events if self.alert(e, now)]
+        # Due if time + offset <= now < time + offset + duration
+        offset, duration = self.alert_window
+        now = now.timestamp() - offset * 60
+        with self.timed('alert'):
+            return self.events_between(now - duration * 60, now)
+
+    # Timings of each phase of a run, for finding out where the time goes
+
+    @contextlib.contextmanager
+    def timed(self, phase, **info):
+        """Time the with block as phase; extra info can be added to the yielded dict."""
+        start = time.time()
+        try:
+            yield info
+        finally:
+            info.update(phase=phase, seconds=time.time() - start)
+            self.timings.append(info)
+
+    def export_metrics(self):
+        args = self.scheduler_args
+        timings, self.timings = self.timings, []
+        self.last_timings = timings
+        if args.metrics_json:
+            line = {'bot': self.name, 'action': args.action, 'time': time.time(), 'timings': timings}
+            with open(args.metrics_json, 'a') as fp:
+                fp.write(json.dumps(line) + '\n')
+        if args.metrics_dir:
+            phases = {}
+            for timing in timings:
+                phase = phases.setdefault(timing['phase'], [0, 0, 0])
+                phase[0] += 1
+                phase[1] += timing['seconds']
+                phase[2] += timing.get('bytes', 0)
+            labels = 'bot="%s",action="%s"' % (self.name, args.action)
+            out = ['scheduler_last_run_timestamp_seconds{%s} %f' % (labels, time.time())]
+            for name, (count, seconds, size) in sorted(phases.items()):
+                out.append('scheduler_phase_count{%s,phase="%s"} %d' % (labels, name, count))
+                out.append('scheduler_phase_seconds{%s,phase="%s"} %f' % (labels, name, seconds))
+                if size:
+                    out.append('scheduler_phase_bytes{%s,phase="%s"} %d' % (labels, name, size))
+            # The collector must never see a half-written file
+            filename = os.path.join(args.metrics_dir, 'scheduler_%s_%s.prom' % (self.name, args.action))
+            write_file(filename, '\n'.join(out) + '\n')
+
     def run(self):
         args = self.scheduler_args
-        func = getattr(self, 'do_' + args.action, None)
-        if func:
-            func()
-        else:
+        func = getattr(self, 'do_' + args.action.replace('-', '_'), None)
+        if not func:
             self.scheduler_parser.print_help()
+            return
+        if args.cprofile:
+            import cProfile
+            profile = cProfile.Profile()
+        try:
+            if args.cprofile:
+                profile.runcall(func)
+            else:
+                func()
+        finally:
+            if args.cprofile:
+                profile.dump_stats(args.cprofile)
+            self.export_metrics()
 
     def do_fetch(self):
-        if self.fetch():
+        if self.fetch_recorded():
             print("New schedule downloaded")
             self.do_test()
 
+    def do_fetch_auto(self):
+        if self.fetch_due():
+            self.do_fetch()
+        else:
+            self.log.debug('Not due a fetch')
+
     def do_test(self):
         for event in self.parse(warn=1):
             print(event)
 
     def do_post(self):
         now = arrow.utcnow()
-        self.alert_on = [e for e in self.parse() if self.alert(e, now)]
-        if self.alert_on or '--setup' in sys.argv:
-            super().run()  # Kick off actual bot
+        self.alert_on = self.alert_due(now)
+        if self.alert_on or '--setup' in self.scheduler_left:
+            self.run_polybot()
+
+    def do_serve(self):
+        self.alert_on = []
+        self.run_polybot()  # Calls serve() from main()
+
+    def serve(self):
+        """Post events as their alert windows open, reloading when the schedule changes."""
+        self.log.info('Serving')
+        key = None
+        queue = []
+        while True:
+            current = []
+            for filename in self.parse_files():
+                try:
+                    st = os.stat(filename)
+                    current.append((filename, st.st_mtime_ns, st.st_size))
+                except FileNotFoundError:
+                    current.append((filename, None, None))
+            if current != key:
+                # Queue every window not yet closed, including any already
+                # open; the outbox skips whatever has been posted
+                key = current
+                queue = []
+                now = arrow.utcnow().timestamp()
+                for i, event in enumerate(self.parse_cached()):
+                    start = self.alert_start(event).timestamp()
+                    if start + self.alert_window[1] * 60 > now:
+                        queue.append((start, i, event))
+                heapq.heapify(queue)
+                self.log.info('Loaded schedule, %d upcoming' % len(queue))
+
+            now = arrow.utcnow()
+            due = []
+            while queue and queue[0][0] <= now.timestamp():
+                event = heapq.heappop(queue)[2]
+                if self.alert(event, now):
+                    due.append(event)
+            if due:
+                self.post_events(due)
+                self.export_metrics()
+
+            wait = self.serve_poll
+            if queue:
+                wait = min(wait, queue[0][0] - arrow.utcnow().timestamp())
+            time.sleep(max(wait, 0))
+
+    def run_polybot(self):
+        """Kick off actual bot, which calls main(). Polybot reads its options
+        from the command line, so it is given just those."""
+        argv, sys.argv = sys.argv, sys.argv[:1] + self.scheduler_left
+        try:
+            self.polybot = polybot(self)
+            self.log = self.polybot.log
+            self.polybot.run()
+        finally:
+            sys.argv = argv
+
+    def post(self, *args, **kwargs):
+        return self.polybot.post(*args, **kwargs)
 
     def main(self):
+        if self.scheduler_args.action == 'serve':
+            self.serve()
+        else:
+            self.post_events(self.alert_on)
+
+    @property
+    def outboxfile(self):
+        return '%s%s.outbox' % (self.path, self.name)
+
+    def post_events(self, events):
+        from outbox import Outbox, event_id
         self.log.info('Posting at ' + arrow.now().format())
-        for event in self.alert_on:
-            if event.image:
-                self.post(event.status, imagefile=event.image, mime_type='image/jpeg', wrap=True)
-            else:
-                self.post(event.status, wrap=True)
+        items = []
+        for event in events:
+            with self.timed('image'):
+                image = event.image
+            status = event.status
+            items.append((event_id(self, event), status, image))
+        # Only remember real posts, so test runs can be repeated
+        args = self.polybot.args
+        Outbox(self, self.outboxfile, record=args.live or args.interactive).send(items)
+
+    # HTTP validators (ETag/Last-Modified) per URL, so a conditional fetch of
+    # an unchanged page gets a 304 and no body.
+
+    @property
+    def validatorfile(self):
+        return '%s-validators' % (self.localfile % self.name)
+
+    def get_validators(self):
+        try:
+            return json.load(open(self.validatorfile))
+        except (IOError, ValueError):
+            return {}
 
-    def get_contents(self, s, mode='text'):
+    def save_validators(self, url, r):
+        validators = self.get_validators()
+        validators[url] = {k: r.headers[k] for k in ('ETag', 'Last-Modified') if k in r.headers}
+        try:
+            write_file(self.validatorfile, json.dumps(validators))
+        except IOError:
+            pass
+
+    def get_contents(self, s, mode='text', conditional=False):
+        """Return the contents of a file or URL, or None if the URL could not
+        be reached. A conditional fetch of a URL returns '' if it has not
+        changed since the schedule was saved."""
         if 'http://' in s or 'https://' in s:
+            import requests
             headers = {'User-Agent': 'Mozilla/5.0 (Macintosh; Intel Mac OS X 10_12_6) AppleWebKit/537.36 ' +
                        '(KHTML, like Gecko) Chrome/68.0.3440.106 Safari/537.36'}
-            try:
-                r = requests.get(s, headers=headers)
-                o = r.content if mode == 'binary' else r.text
-            except requests.exceptions.ConnectionError:
-                o = ''
+            # Without a saved schedule, there is nothing to compare against
+            if conditional and os.path.exists(self.localfile % self.name):
+                validators = self.get_validators().get(s, {})
+                if 'ETag' in validators:
+                    headers['If-None-Match'] = validators['ETag']
+                if 'Last-Modified' in validators:
+                    headers['If-Modified-Since'] = validators['Last-Modified']
+            with self.timed('get_contents', url=s, bytes=0) as info:
+                try:
+                    r = (self.session or requests).get(s, headers=headers)
+                    info['bytes'] = len(r.content)
+                    if conditional and r.status_code == 304:
+                        return ''
+                    o = r.content if mode == 'binary' else r.text
+                    if conditional and r.status_code == 200:
+                        self.save_validators(s, r)
+                except requests.exceptions.ConnectionError:
+                    o = None
         else:
             mode = 'rb' if mode == 'binary' else 'rt'
             o = open(s, newline='', mode=mode).read()
         return o
 
     def get_image(self, u):
+        """Download an image, backing off between tries. Returns None on failure."""
         for i in range(3):
+            if i:
+                time.sleep(2 ** i)
             try:
                 f = self.get_contents(u, mode='binary')
-                return f
+                if f:
+                    return f
             except IOError:
                 pass
-        raise
+        self.log.warning('Could not fetch image %s' % u)
+        return None
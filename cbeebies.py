@@ -6,45 +6,107 @@
 # Copyright (c) 2018 Matthew Somerville.
 # http://www.dracos.co.uk/
 
+import argparse
+import datetime
 import json
-import sys
-import arrow
-from bot import SchedulerBot, Event
+import logging
+import os
+import re
+import time
+from concurrent.futures import ThreadPoolExecutor
+from bot import SchedulerBot, Event, run_all, write_file
 from config import SHOWS
+try:
+    from config import CBEEBIES_FETCH_WORKERS
+except ImportError:
+    CBEEBIES_FETCH_WORKERS = 4
 
 
 class Event(Event):
+    __slots__ = ('bot', 'title', 'series', 'episode', 'synopsis', 'image_pid')
+
     def __str__(self):
         return '%s %s %s %s' % (self.bot.name, self.time, self.image_url, self.status)
 
+    @property
+    def image_url(self):
+        return 'http://ichef.bbci.co.uk/images/ic/192x108/%s.jpg' % self.image_pid
+
     @property
     def image(self):
-        return self.bot.get_image(self.image_url)
+        return self.bot.get_cached_image(self.image_url)
 
     @property
     def status(self):
         return '%s (s%se%s) starting shortly!\n\u201c%s\u201d' % (
-            self.programme['title'],
-            self.programme['programme']['position'],
-            self.programme['position'],
-            self.programme['short_synopsis'],
-        )
+            self.title, self.series, self.episode, self.synopsis)
 
 
 class CBeebiesBot(SchedulerBot):
     localfile = '/home/sympl/scheduler/data/%s-schedule'
+    imagedir = '/home/sympl/scheduler/data/%s-images/'
+    image_max_age = 14 * 86400  # Seconds an image no longer needed is kept
+    image_max_size = 20 * 1024 * 1024  # Bytes of images no longer needed to keep
+
+    not_got = re.compile('Maintenance mode')
 
-    not_got = 'Maintenance mode'
+    alert_window = (-10, 10)
 
     def fetch(self):
         pid = SHOWS[self.name]
         url = 'http://www.bbc.co.uk/programmes/%s/episodes/upcoming.json'
-        new = self.get_contents(url % pid)
-        self.fetch_check_file(new)
-        return False
+        new = self.get_contents(url % pid, conditional=True)
+        changed = self.fetch_check_file(new)
+        self.fetch_images()
+        return changed
 
-    def fetch_diff(self, a, b):
-        return a != b
+    # Episode stills are downloaded at fetch time, named by image pid, so
+    # that posting only has to read them from disk.
+
+    def image_file(self, url):
+        return (self.imagedir % self.name) + url.rsplit('/', 1)[1]
+
+    def get_cached_image(self, url):
+        try:
+            return open(self.image_file(url), 'rb').read()
+        except IOError:
+            return self.get_image(url)
+
+    def fetch_images(self):
+        os.makedirs(self.imagedir % self.name, exist_ok=True)
+        now = time.time()
+        wanted = set()
+        for event in self.events_between(now - 1):
+            filename = self.image_file(event.image_url)
+            wanted.add(filename)
+            if os.path.exists(filename):
+                continue
+            with self.timed('image', url=event.image_url):
+                data = self.get_image(event.image_url)
+            if not data or data[:2] != b'\xff\xd8':  # Not a JPEG
+                continue
+            write_file(filename, data)
+        self.evict_images(wanted)
+
+    def evict_images(self, wanted):
+        """Remove images no longer wanted that are too old, then the oldest
+        of the rest until they fit in image_max_size."""
+        cutoff = time.time() - self.image_max_age
+        files = []
+        for entry in os.scandir(self.imagedir % self.name):
+            if entry.path in wanted:
+                continue
+            st = entry.stat()
+            if st.st_mtime < cutoff:
+                os.remove(entry.path)
+            else:
+                files.append((st.st_mtime, st.st_size, entry.path))
+        size = sum(f[1] for f in files)
+        for mtime, file_size, filename in sorted(files):
+            if size <= self.image_max_size:
+                break
+            os.remove(filename)
+            size -= file_size
 
     def parse(self, warn=0):
         d = self.parse_get_file(warn)
@@ -58,20 +120,60 @@ class CBeebiesBot(SchedulerBot):
 
         events = []
         for broadcast in j['broadcasts']:
-            image_pid = broadcast['programme']['image']['pid']
-            image_url = 'http://ichef.bbci.co.uk/images/ic/192x108/%s.jpg' % image_pid
-            time = arrow.get(broadcast['start'])
+            programme = broadcast['programme']
+            # fromisoformat() only takes a "Z" for UTC from Python 3.11
+            start = broadcast['start']
+            if start.endswith('Z'):
+                start = start[:-1] + '+00:00'
             events.append(
-                Event(bot=self, time=time, programme=broadcast['programme'],
-                      image_url=image_url)
+                Event(bot=self, time=datetime.datetime.fromisoformat(start),
+                      title=programme['title'], series=programme['programme']['position'],
+                      episode=programme['position'], synopsis=programme['short_synopsis'],
+                      image_pid=programme['image']['pid'])
             )
-        return sorted(events, key=lambda s: s.time)
+        return sorted(events, key=lambda s: s.epoch)
 
-    def alert(self, event, now):
-        return now >= event.time.shift(minutes=-10) and now < event.time
 
+def fetch_all(bots, workers=CBEEBIES_FETCH_WORKERS):
+    """Fetch every show at once, over one pool of keep-alive connections."""
+    import requests
+    session = requests.Session()
+    adapter = requests.adapters.HTTPAdapter(pool_connections=1, pool_maxsize=workers)
+    session.mount('http://', adapter)
+    session.mount('https://', adapter)
 
-for key in SHOWS.keys():
-    argv = sys.argv.copy()
-    CBeebiesBot(key).run()
-    sys.argv = argv
+    def fetch(bot):
+        start = time.time()
+        bot.session = session
+        try:
+            bot.fetch_recorded()
+        finally:
+            bot.export_metrics()
+        return time.time() - start
+
+    log = logging.getLogger(__name__)
+    p = argparse.ArgumentParser()
+    p.add_argument('--loglevel', default='INFO')
+    args, _ = p.parse_known_args()
+    log.setLevel(args.loglevel)
+    start = time.time()
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        for bot, taken in zip(bots, pool.map(fetch, bots)):
+            log.debug('Fetched %s in %.2fs' % (bot.name, taken))
+    log.debug('Fetched %d shows in %.2fs' % (len(bots), time.time() - start))
+    session.close()
+
+
+def bots(argv=None):
+    return [CBeebiesBot(key, argv) for key in SHOWS]
+
+
+if __name__ == '__main__':
+    running = bots()
+    action = running and running[0].scheduler_args.action
+    if action == 'fetch':
+        fetch_all(running)
+    elif action == 'fetch-auto':
+        fetch_all([bot for bot in running if bot.fetch_due()])
+    else:
+        run_all(running)
@@ -6,89 +6,328 @@
 # Copyright (c) 2018 Matthew Somerville.
 # http://www.dracos.co.uk/
 
+import calendar
+import datetime
+import fcntl
 import json
+import os
 import re
-import arrow
-from bot import SchedulerBot, Event
+import struct
+import threading
+import time
+from dateutil import tz
+from bot import SchedulerBot, Event, run_all, write_file
 from config import LATITUDE, LONGITUDE, ALTITUDE, FORECASTIO_KEY
+try:
+    from config import ISS_LOCATIONS
+except ImportError:
+    ISS_LOCATIONS = None
 
 
 localfile = '/home/sympl/scheduler/data/%s'
 
 
 class Event(Event):
+    __slots__ = ('magnitude', 'start_time', 'end_time', 'start_az', 'end_az', 'max_time', 'max_alt', 'max_az',
+                 'bot')
+
     @property
-    def status(self):
-        text = "ISS pass: magnitude %.1f, %s\u2013%s from %s to %s, maximum altitude %s at %s in %s. Weather: %s."
+    def description(self):
+        text = "ISS pass: magnitude %.1f, %s\u2013%s from %s to %s, maximum altitude %s at %s in %s."
         return (text % (float(self.magnitude), self.start_time, self.end_time, self.start_az, self.end_az,
-                        self.max_alt, self.max_time, self.max_az, self.weather))
+                        self.max_alt, self.max_time, self.max_az))
+
+    @property
+    def status(self):
+        text = self.description
+        weather = self.bot.weather_for(self)
+        if weather:
+            text += " Weather: %s." % weather
+        return text
+
+
+LONDON = tz.gettz('Europe/London')
+MONTHS = {m.lower(): i for i, m in enumerate(calendar.month_abbr) if m}
+
+# The formats heavens-above has used for a pass's date and start time, as
+# (regex, group numbers of month, day, hour, minute, second, am/pm)
+TIME_FORMATS = [
+    (re.compile(r'([A-Za-z]{3}) (\d{1,2}), (\d\d):(\d\d):(\d\d)$'), (1, 2, 3, 4, 5, None)),
+    (re.compile(r'([A-Za-z]{3}) (\d\d) (\d\d):(\d\d):(\d\d) ([AaPp][Mm])$'), (1, 2, 3, 4, 5, 6)),
+    (re.compile(r'(\d\d) ([A-Za-z]{3}) (\d\d):(\d\d):(\d\d)$'), (2, 1, 3, 4, 5, None)),
+]
+
+
+class Timestamps(object):
+    """Converts the pass times from one page, all in the same format and in
+    UK time, to epoch seconds, picking the year that puts them in the future."""
+
+    def __init__(self, now=None):
+        self.now = time.time() if now is None else now
+        self.year = datetime.datetime.fromtimestamp(self.now, LONDON).year
+        self.format = None
+        self.offsets = {}  # UTC offset by (year, month, day, hour)
+
+    def parse(self, s):
+        if self.format is None:
+            self.format = next(f for f in TIME_FORMATS if f[0].match(s))
+        regex, groups = self.format
+        m = regex.match(s)
+        month, day, hour, minute, second = (m.group(g) for g in groups[:5])
+        month = MONTHS[month.lower()]
+        day, hour, minute, second = int(day), int(hour), int(minute), int(second)
+        if groups[5]:
+            ampm = m.group(groups[5]).lower()
+            if ampm == 'pm' and hour < 12:
+                hour += 12
+            elif ampm == 'am' and hour == 12:
+                hour = 0
+        timestamp = self.epoch(self.year, month, day, hour, minute, second)
+        # Deal with around New Year time
+        if timestamp < self.now:
+            timestamp = self.epoch(self.year + 1, month, day, hour, minute, second)
+        return timestamp
+
+    def epoch(self, year, month, day, hour, minute, second):
+        key = (year, month, day, hour)
+        if key not in self.offsets:
+            offset = datetime.datetime(year, month, day, hour, tzinfo=LONDON).utcoffset()
+            self.offsets[key] = int(offset.total_seconds())
+        return calendar.timegm((year, month, day, hour, minute, second)) - self.offsets[key]
 
 
 def get_timestamp(s):
-    s = arrow.get(s, ['MMM D, HH:mm:ss', 'MMM DD HH:mm:ss a', 'DD MMM HH:mm:ss'])
-    now = arrow.now()
-    s = s.replace(year=now.year, tzinfo='Europe/London')
-    # Deal with around New Year time
-    if s < now:
-        s = s.shift(years=1)
-    return str(s.int_timestamp)
+    return str(Timestamps().parse(s))
+
+
+REGEX_CELL = re.compile('<td[^>]*>(.*?)</td>', re.S)
+REGEX_TAG = re.compile('<[^>]*>')
+
+
+def pass_rows(page):
+    """Yield the cells of each pass in a heavens-above PassSummary page."""
+    start = '<tr class="clickableRow"'
+    pos = page.find(start)
+    while pos != -1:
+        end = page.find('</tr>', pos)
+        if end == -1:
+            end = len(page)
+        cells = [REGEX_TAG.sub('', cell).strip() for cell in REGEX_CELL.findall(page, pos, end)]
+        if len(cells) == 12:
+            yield cells
+        pos = page.find(start, end)
+
+
+# The pass table: epoch of the start, magnitude, then start time, end time,
+# start azimuth, end azimuth, time, altitude and azimuth of the highest point,
+# after a header that changes whenever the layout does
+PASS_HEADER = b'passes 2\n'
+PASS_FIELD_SIZE = 16  # Room for a time such as "07:23:45 PM"
+PASS_RECORD = struct.Struct('<qd' + ('%ds' % PASS_FIELD_SIZE) * 7)
+TLE_URL = 'https://celestrak.org/NORAD/elements/gp.php?CATNR=25544&FORMAT=TLE'
+TLE_MAX_AGE = 4 * 3600  # Seconds to use a saved orbit for before downloading it again
 
 
 class ISSBot(SchedulerBot):
     choices = SchedulerBot.choices + ['weather']
+    alert_window = (-30, 5)
+    weather_ttl = 15 * 60  # Seconds a weather lookup is good for
+    weather_horizon = 45 * 60  # Only look up weather for a pass starting within this many seconds
+    weather_lock = threading.Lock()
+    predict = False  # Work out passes from the ISS's orbit, rather than fetching them from heavens-above
 
-    def __init__(self, name, latitude, longitude, altitude, forecastio_key):
+    def __init__(self, name, latitude, longitude, altitude, forecastio_key, argv=None):
         self.latitude = latitude
         self.longitude = longitude
         self.altitude = altitude
         self.forecastio_key = forecastio_key
-        super().__init__(name)
+        super().__init__(name, argv)
 
-    def do_weather(self):
+    @property
+    def weatherfile(self):
+        return localfile % ('%s-weather.json' % self.name)
+
+    @property
+    def passesfile(self):
+        return localfile % ('%s.passes' % self.name)
+
+    def weather_key(self, now):
+        """Forecasts are shared by everything asking about the same place in
+        the same TTL-sized slice of time."""
+        return '%s,%s/%d' % (self.latitude, self.longitude, now // self.weather_ttl)
+
+    def weather_cached(self):
+        try:
+            return json.load(open(self.weatherfile)) or {}
+        except (IOError, ValueError):
+            return {}
+
+    def weather_fetch(self):
         url = 'https://api.forecast.io/forecast/%s/%s,%s?units=uk2&exclude=minutely,hourly,daily,alerts,flags'
         url = url % (self.forecastio_key, self.latitude, self.longitude)
-        fp = self.get_contents(url)
-        weather = json.loads(fp)
-        json.dump(weather['currently'], open(localfile % 'weather.json', 'w'))
+        try:
+            return json.loads(self.get_contents(url))['currently']['summary']
+        except (ValueError, KeyError, TypeError):
+            return None
+
+    def weather(self, refresh=True):
+        """Return a summary of the current weather, looking it up at most once
+        per key however many threads or processes ask. If the lookup fails,
+        the last summary we had is returned, however old."""
+        key = self.weather_key(time.time())
+        cached = self.weather_cached()
+        if cached.get('key') == key or not refresh:
+            return cached.get('summary')
+        with self.weather_lock, open(self.weatherfile + '.lock', 'w') as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            cached = self.weather_cached()
+            if cached.get('key') == key:
+                return cached.get('summary')
+            summary = self.weather_fetch()
+            if summary is None:
+                self.log.warning('Weather lookup failed, using last known: %s' % cached.get('summary'))
+                return cached.get('summary')
+            write_file(self.weatherfile, json.dumps({'key': key, 'summary': summary, 'fetched': time.time()}))
+            return summary
+
+    def weather_for(self, event):
+        """Only a pass within the horizon is worth paying for a lookup."""
+        return self.weather(refresh=event.epoch - time.time() < self.weather_horizon)
+
+    def do_weather(self):
+        """Look up the weather ahead of an upcoming pass, so that posting
+        does not have to wait for it. Does nothing if no pass is near."""
+        now = time.time()
+        if self.events_between(now - self.alert_window[1] * 60, now + self.weather_horizon):
+            self.weather()
 
     def fetch(self):
+        if self.predict:
+            return fetch_predicted([self])[0]
         url = 'http://www.heavens-above.com/PassSummary.aspx?satid=25544&lat=%f&lng=%f&alt=%d&tz=GMT'
         url = url % (self.latitude, self.longitude, self.altitude)
         iss = self.get_contents(url)
-        rows = re.findall('<tr class="clickableRow"[^>]*>\s*<td><a href="[^"]*" title="[^"]*">(.*?)</a></td>' +
-                          ('<td[^>]*>\s*(.*?)\s*</td>' * 11), iss)
-        fp = open(localfile % 'iss.tsv', 'w')
-        for row in rows:
+        if not iss:
+            return None
+        timestamps = Timestamps()
+        out = []
+        for row in pass_rows(iss):
             date, mag, start_time, start_alt, start_az, max_time, max_alt, max_az, \
                 end_time, end_alt, end_az, pass_type = row
-            timestamp = get_timestamp('%s %s' % (date, start_time))
-            out = (timestamp, mag, start_time, end_time, start_az, end_az, max_time, max_alt, max_az)
-            fp.write("\t".join(out) + "\n")
-        fp.close()
+            try:
+                mag = float(mag)
+                timestamp = timestamps.parse('%s %s' % (date, start_time))
+            except (ValueError, KeyError, StopIteration):
+                continue
+            fields = (start_time, end_time, start_az, end_az, max_time, max_alt, max_az)
+            out.append((timestamp, mag) + fields)
+        return self.save_passes(out)
 
-    def parse(self, warn=0):
-        weather = json.load(open(localfile % 'weather.json'))
-        if not weather:
-            return []  # Problem with weather file
-        weather_desc = weather['summary']
+    def save_passes(self, passes):
+        """Save passes, (start epoch, magnitude, start time, end time, start
+        azimuth, end azimuth, max time, max altitude, max azimuth) tuples,
+        returning whether they have changed."""
+        out = [PASS_HEADER]
+        for p in passes:
+            fields = [f.encode('utf-8') for f in p[2:]]
+            if any(len(f) > PASS_FIELD_SIZE for f in fields):
+                raise ValueError('Pass field too long to save: %r' % (p,))
+            out.append(PASS_RECORD.pack(p[0], p[1], *fields))
+        out = b''.join(out)
+        try:
+            if open(self.passesfile, 'rb').read() == out:
+                return False
+        except IOError:
+            pass
+        write_file(self.passesfile, out)
+        self.store_update()
+        return True
+
+    overridefile = None
+
+    def parse_files(self):
+        return [self.passesfile]
 
+    def summary(self, event):
+        return event.description  # Without looking up the weather
+
+    def parse(self, warn=0):
         events = []
 
-        iss = open(localfile % 'iss.tsv')
-        for row in iss:
-            epoch, mag, start_time, end_time, start_az, end_az, max_time, max_alt, max_az = row.strip().split("\t")
-            epoch = arrow.get(epoch, 'X').to('Europe/London')
+        try:
+            iss = open(self.passesfile, 'rb').read()
+        except FileNotFoundError:
+            if warn:
+                print('No passes saved for %s' % self.name)
+            return events
+        if not iss.startswith(PASS_HEADER):
+            return events  # Saved in an older layout, until the next fetch
+        for row in PASS_RECORD.iter_unpack(iss[len(PASS_HEADER):]):
+            epoch, mag = row[:2]
+            start_time, end_time, start_az, end_az, max_time, max_alt, max_az = (
+                f.rstrip(b'\0').decode('utf-8', 'ignore') for f in row[2:])
             events.append(
-                Event(time=epoch,
+                Event(epoch=epoch, tz=LONDON,
                       magnitude=mag, start_time=start_time, end_time=end_time, start_az=start_az, end_az=end_az,
-                      max_time=max_time, max_alt=max_alt, max_az=max_az, weather=weather_desc)
+                      max_time=max_time, max_alt=max_alt, max_az=max_az, bot=self)
             )
 
-        return sorted(events, key=lambda s: s.time)
+        return sorted(events, key=lambda s: s.epoch)
+
+
+def fetch_tle(bot):
+    """Return the ISS's orbit, downloading it only if the saved one is more
+    than TLE_MAX_AGE old, and using that if the download fails. Returns
+    None if there is neither."""
+    filename = localfile % 'iss.tle'
+    try:
+        fresh = time.time() - os.path.getmtime(filename) < TLE_MAX_AGE
+    except OSError:
+        fresh = False
+    if not fresh:
+        tle = bot.get_contents(TLE_URL) or ''
+        tle = [line.strip() for line in tle.splitlines() if line[:2] in ('1 ', '2 ')]
+        if len(tle) == 2:
+            write_file(filename, '\n'.join(tle) + '\n')
+            return tle
+    try:
+        return open(filename).read().splitlines()
+    except IOError:
+        return None
+
+
+def fetch_predicted(bots):
+    """Work out the passes over every bot's location in one go, from the
+    latest orbit of the ISS. Returns whether each bot's passes have changed."""
+    from isspredict import predict
+    tle = fetch_tle(bots[0])
+    if not tle:
+        return [None] * len(bots)
+    with bots[0].timed('predict', locations=len(bots)):
+        passes = predict(tle, [(bot.latitude, bot.longitude, bot.altitude) for bot in bots], time.time())
+    return [bot.save_passes(p) for bot, p in zip(bots, passes)]
+
 
-    def alert(self, event, now):
-        soon = now.shift(minutes=30)
-        return soon >= event.time and soon < event.time.shift(minutes=5)
+def bots(argv=None):
+    """The one bot over LATITUDE and LONGITUDE, or with ISS_LOCATIONS a bot
+    predicting passes over each of them."""
+    if not ISS_LOCATIONS:
+        return [ISSBot('abovebrum', LATITUDE, LONGITUDE, ALTITUDE, FORECASTIO_KEY, argv)]
+    out = []
+    for name, (latitude, longitude, altitude) in ISS_LOCATIONS.items():
+        out.append(ISSBot(name, latitude, longitude, altitude, FORECASTIO_KEY, argv))
+        out[-1].predict = True
+    return out
 
 
-ISSBot('abovebrum', LATITUDE, LONGITUDE, ALTITUDE, FORECASTIO_KEY).run()
+if __name__ == '__main__':
+    running = bots()
+    action = running[0].scheduler_args.action
+    if ISS_LOCATIONS and action in ('fetch', 'fetch-auto'):
+        due = [bot for bot in running if action == 'fetch' or bot.fetch_due()]
+        if due:
+            for bot, changed in zip(due, fetch_predicted(due)):
+                bot.fetch_record(changed)
+                bot.export_metrics()
+    else:
+        run_all(running)
@@ -0,0 +1,226 @@
+#!/usr/bin/env python
+#
+# isspredict.py:
+# Predict visible ISS passes from its orbital elements, for many places at once
+#
+# Copyright (c) 2018 Matthew Somerville.
+# http://www.dracos.co.uk/
+#
+# The ISS is propagated with SGP4 over a grid of times, and looked at from
+# every location at once as NumPy arrays of (locations, times). A pass is
+# visible, as on heavens-above, while the ISS is at least 10 degrees up and
+# in sunlight with the sky dark enough; each one found on the coarse grid is
+# then worked out to the second.
+
+import calendar
+import os
+import sys
+import time
+import numpy as np
+from sgp4.api import Satrec
+
+EARTH_RADIUS = 6378.137  # km, WGS84
+EARTH_FLATTENING = 1 / 298.257223563
+MIN_ALTITUDE = 10  # Degrees above the horizon for a pass to count
+MAX_SUN_ALTITUDE = -6  # Degrees; the sky is too bright with the Sun higher than this
+STANDARD_MAGNITUDE = -1.8  # Of the ISS at 1000km and half lit
+CHUNK = 500000  # (location, time) pairs to work on at once
+COMPASS = ['N', 'NNE', 'NE', 'ENE', 'E', 'ESE', 'SE', 'SSE', 'S', 'SSW', 'SW', 'WSW', 'W', 'WNW', 'NW', 'NNW']
+
+
+def julian(t):
+    """Split epoch seconds into the two parts of a Julian date SGP4 takes."""
+    days = np.asarray(t, dtype=float) / 86400
+    whole = np.floor(days)
+    return whole + 2440587.5, days - whole
+
+
+def sidereal(jd, fr):
+    """Greenwich mean sidereal time in radians (IAU 1982)."""
+    t = (jd - 2451545 + fr) / 36525
+    seconds = 67310.54841 + (876600 * 3600 + 8640184.812866) * t + 0.093104 * t ** 2 - 6.2e-6 * t ** 3
+    return np.radians((seconds % 86400) / 240)
+
+
+def earth_fixed(v, theta):
+    """Rotate inertial vectors (times, 3) into the Earth's frame."""
+    c, s = np.cos(theta), np.sin(theta)
+    return np.stack([c * v[:, 0] + s * v[:, 1], c * v[:, 1] - s * v[:, 0], v[:, 2]], axis=-1)
+
+
+def sun_direction(jd, fr):
+    """Unit vectors (times, 3) towards the Sun, good to about 0.01 degrees."""
+    n = jd - 2451545 + fr
+    g = np.radians(357.528 + 0.9856003 * n)
+    lon = np.radians(280.460 + 0.9856474 * n + 1.915 * np.sin(g) + 0.020 * np.sin(2 * g))
+    obliquity = np.radians(23.439 - 0.0000004 * n)
+    return np.stack([np.cos(lon), np.cos(obliquity) * np.sin(lon), np.sin(obliquity) * np.sin(lon)], axis=-1)
+
+
+class Observers(object):
+    """Places on the ground, from (latitude, longitude, altitude in metres)
+    tuples, as Earth-fixed positions in km and local east/north/up vectors,
+    each (locations, 3)."""
+
+    def __init__(self, locations):
+        self.locations = list(locations)
+        lat, lon, height = np.array(self.locations, dtype=float).reshape(-1, 3).T
+        lat, lon, height = np.radians(lat), np.radians(lon), height / 1000
+        e2 = EARTH_FLATTENING * (2 - EARTH_FLATTENING)
+        n = EARTH_RADIUS / np.sqrt(1 - e2 * np.sin(lat) ** 2)
+        self.position = np.stack([(n + height) * np.cos(lat) * np.cos(lon), (n + height) * np.cos(lat) * np.sin(lon),
+                                  (n * (1 - e2) + height) * np.sin(lat)], axis=-1)
+        self.east = np.stack([-np.sin(lon), np.cos(lon), np.zeros_like(lon)], axis=-1)
+        self.north = np.stack([-np.sin(lat) * np.cos(lon), -np.sin(lat) * np.sin(lon), np.cos(lat)], axis=-1)
+        self.up = np.stack([np.cos(lat) * np.cos(lon), np.cos(lat) * np.sin(lon), np.sin(lat)], axis=-1)
+
+    def __len__(self):
+        return len(self.locations)
+
+    def __getitem__(self, i):
+        return Observers(self.locations[i:i + 1])
+
+
+def position(satellite, t):
+    """Return the Earth-fixed positions of the ISS and directions to the Sun,
+    (times, 3), and whether the ISS is in sunlight at times t."""
+    jd, fr = julian(t)
+    error, r, v = satellite.sgp4_array(jd, fr)
+    sun = sun_direction(jd, fr)
+
+    # In sunlight unless behind the Earth, in its cylinder of shadow
+    along = np.einsum('tk,tk->t', r, sun)
+    sunlit = (along > 0) | (np.linalg.norm(r - along[:, None] * sun, axis=1) > EARTH_RADIUS)
+    sunlit &= error == 0
+
+    theta = sidereal(jd, fr)
+    return earth_fixed(r, theta), earth_fixed(sun, theta), sunlit
+
+
+def visible_at(satellite, t, observers):
+    """Return whether the ISS can be seen, (locations, times), for times t.
+    Only what is needed for that is worked out, and only while it is lit."""
+    r, sun, sunlit = position(satellite, t)
+    visible = np.zeros((len(observers), len(t)), dtype=bool)
+    lit = np.flatnonzero(sunlit)
+    rho = r[None, lit, :] - observers.position[:, None, :]
+    high = np.einsum('ntk,nk->nt', rho, observers.up) >= np.sin(np.radians(MIN_ALTITUDE)) * np.linalg.norm(rho, axis=2)
+    dark = observers.up @ sun[lit].T < np.sin(np.radians(MAX_SUN_ALTITUDE))
+    visible[:, lit] = high & dark
+    return visible
+
+
+def look(satellite, t, observers):
+    """Return the ISS's altitude and azimuth in degrees, its magnitude, and
+    whether it can be seen, as arrays (locations, times) for times t."""
+    r, sun, sunlit = position(satellite, t)
+    rho = r[None, :, :] - observers.position[:, None, :]
+    distance = np.linalg.norm(rho, axis=2)
+    altitude = np.degrees(np.arcsin(np.einsum('ntk,nk->nt', rho, observers.up) / distance))
+    azimuth = np.degrees(np.arctan2(np.einsum('ntk,nk->nt', rho, observers.east),
+                                    np.einsum('ntk,nk->nt', rho, observers.north))) % 360
+    sun_altitude = np.degrees(np.arcsin(np.einsum('tk,nk->nt', sun, observers.up)))
+
+    # As a diffusely reflecting sphere, by the angle between Sun and observer
+    phase = np.arccos(np.clip(-np.einsum('ntk,tk->nt', rho, sun) / distance, -1, 1))
+    lit = ((np.pi - phase) * np.cos(phase) + np.sin(phase))
+    with np.errstate(divide='ignore'):
+        magnitude = STANDARD_MAGNITUDE + 5 * np.log10(distance / 1000) - 2.5 * np.log10(lit)
+
+    visible = (altitude >= MIN_ALTITUDE) & sunlit[None, :] & (sun_altitude < MAX_SUN_ALTITUDE)
+    return altitude, azimuth, magnitude, visible
+
+
+def compass(azimuth):
+    return COMPASS[int((azimuth + 11.25) % 360 // 22.5)]
+
+
+def clock(t):
+    return time.strftime('%H:%M:%S', time.gmtime(t))
+
+
+def refine(satellite, t, observer):
+    """Return a pass worked out over the one second grid t, or None if it is
+    not visible at all at that resolution."""
+    altitude, azimuth, magnitude, visible = (a[0] for a in look(satellite, t, observer))
+    seen = np.flatnonzero(visible)
+    if not len(seen):
+        return None
+    first, last = seen[0], seen[-1]
+    top = seen[np.argmax(altitude[seen])]
+    return (int(t[first]), round(float(magnitude[seen].min()), 1),
+            clock(t[first]), clock(t[last]), compass(azimuth[first]), compass(azimuth[last]),
+            clock(t[top]), '%d°' % round(altitude[top]), compass(azimuth[top]))
+
+
+def predict(tle, locations, start, days=10, step=20):
+    """Return the visible passes in the days after start (epoch seconds) for
+    each of locations, (latitude, longitude, altitude in metres) tuples. Each
+    location gets a list of (start epoch, magnitude, start time, end time,
+    start azimuth, end azimuth, max time, max altitude, max azimuth), with
+    times as HH:MM:SS GMT and directions as compass points, as on the
+    heavens-above pass summary."""
+    satellite = Satrec.twoline2rv(*tle[-2:])
+    observers = Observers(locations)
+    # On whole multiples of step, so the same orbit always gives the same passes
+    start = int(start) // step * step
+    t = start + step * np.arange(int(days * 86400 // step))
+    visible = np.zeros((len(observers), len(t)), dtype=bool)
+    chunk = max(1, CHUNK // len(observers))
+    for i in range(0, len(t), chunk):
+        visible[:, i:i + chunk] = visible_at(satellite, t[i:i + chunk], observers)
+
+    # Each run of visible steps is a pass, somewhere within a step either side
+    edges = np.diff(np.pad(visible.view(np.int8), ((0, 0), (1, 1))), axis=1)
+    passes = []
+    for n in range(len(observers)):
+        out = []
+        starts, ends = np.flatnonzero(edges[n] == 1), np.flatnonzero(edges[n] == -1)
+        for first, last in zip(starts, ends):
+            fine = np.arange(t[first] - step, t[last - 1] + step + 1)
+            found = refine(satellite, fine, observers[n])
+            if found:
+                out.append(found)
+        passes.append(out)
+    return passes
+
+
+def read_tle(filename):
+    lines = [line.strip() for line in open(filename) if line.strip()]
+    return lines[-2:]
+
+
+if __name__ == '__main__':
+    # isspredict.py TLE LATITUDE LONGITUDE ALTITUDE [PAGE]: list the passes
+    # over a place, or compare them with those on a saved heavens-above page
+    tle = read_tle(sys.argv[1])
+    location = tuple(float(x) for x in sys.argv[2:5])
+    if len(sys.argv) < 6:
+        for p in predict(tle, [location], time.time())[0]:
+            print(time.strftime('%d %b', time.gmtime(p[0])), *p[1:])
+        sys.exit()
+
+    # The page is in GMT, from around when it was saved
+    from iss import pass_rows
+    page = sys.argv[5]
+    year = time.gmtime(os.path.getmtime(page)).tm_year
+    saved = []
+    for row in pass_rows(open(page).read()):
+        try:
+            when = time.strptime('%s %d %s' % (row[0], year, row[2]), '%d %b %Y %H:%M:%S')
+        except ValueError:
+            continue
+        saved.append((calendar.timegm(when), row))
+    if not saved:
+        sys.exit('No passes on page')
+    passes = predict(tle, [location], saved[0][0] - 3600, days=(saved[-1][0] - saved[0][0]) / 86400 + 1)[0]
+    worst = found = 0
+    for epoch, row in saved:
+        near = min(passes, key=lambda p: abs(p[0] - epoch), default=None)
+        if near is None or abs(near[0] - epoch) > 600:
+            print('Not predicted: %s' % ' '.join(row))
+            continue
+        found += 1
+        worst = max(worst, abs(near[0] - epoch))
+        print('%s saved: %s, predicted: %s' % (row[0], ' '.join(row[1:9]), ' '.join(str(f) for f in near[1:])))
+    print('%d of %d passes predicted, starting at most %ds apart' % (found, len(saved), worst))
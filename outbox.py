@@ -0,0 +1,110 @@
+#!/usr/bin/env python
+#
+# outbox.py:
+# Post to every service at once, and never post the same thing twice
+#
+# Copyright (c) 2018 Matthew Somerville.
+# http://www.dracos.co.uk/
+
+import fcntl
+import hashlib
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from bot import write_file
+
+
+def event_id(bot, event):
+    """A stable ID for an event, the same on every run that sees it. It is
+    made from the event's summary, not its status, which can change between
+    runs, such as when the ISS bot adds the latest weather."""
+    key = '%s\n%d\n%s' % (bot.name, event.epoch, bot.summary(event))
+    return hashlib.sha1(key.encode('utf-8')).hexdigest()
+
+
+class Outbox(object):
+    """Posts each item to all of a bot's Polybot services in parallel, keeping
+    a ledger of what each service has been sent. The ledger is locked while
+    posting, so an overlapping run waits and then skips what was sent."""
+
+    retries = 4  # Tries per post
+    backoff = 2  # Seconds before the first retry, doubling each time
+    min_interval = {}  # Seconds between posts to a service, by service name
+    default_interval = 1
+    keep = 7 * 86400  # Seconds to remember what was sent
+
+    def __init__(self, bot, filename, record=True):
+        self.bot = bot
+        self.filename = filename
+        self.record = record
+        self.lock = threading.Lock()
+
+    def read(self):
+        sent = {}
+        try:
+            fp = open(self.filename)
+        except FileNotFoundError:
+            return sent
+        for line in fp:
+            try:
+                item, service, when = line.split()
+                sent[(item, service)] = float(when)
+            except ValueError:
+                pass
+        return sent
+
+    def send(self, items):
+        """Post items, a list of (id, status, image) tuples."""
+        services = self.bot.polybot.services
+        if not services:
+            for item, status, image in items:
+                self.bot.log.info('No services, not posting: %s' % status)
+            return
+        with open(self.filename + '.lock', 'w') as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            sent = self.read()
+            with ThreadPoolExecutor(max_workers=len(services)) as pool:
+                futures = []
+                for service in services:
+                    todo = [i for i in items if (i[0], service.name) not in sent]
+                    futures.append(pool.submit(self.send_service, service, todo, sent))
+                try:
+                    for future in futures:
+                        future.result()
+                finally:
+                    if self.record:
+                        self.save(sent)
+
+    def send_service(self, service, items, sent):
+        interval = self.min_interval.get(service.name, self.default_interval)
+        last = 0
+        for item, status, image in items:
+            wait = last + interval - time.time()
+            if wait > 0:
+                time.sleep(wait)
+            last = time.time()
+            if self.post(service, status, image):
+                with self.lock:
+                    sent[(item, service.name)] = time.time()
+
+    def post(self, service, status, image):
+        for attempt in range(self.retries):
+            if attempt:
+                time.sleep(self.backoff * 2 ** (attempt - 1))
+            try:
+                with self.bot.timed('post', service=service.name):
+                    if image:
+                        service.post(status, imagefile=image, mime_type='image/jpeg', wrap=True)
+                    else:
+                        service.post(status, wrap=True)
+                return True
+            except Exception as e:
+                self.bot.log.warning('Posting to %s failed (try %d): %s' % (service.name, attempt + 1, e))
+        self.bot.log.error('Giving up posting to %s: %s' % (service.name, status))
+        return False
+
+    def save(self, sent):
+        cutoff = time.time() - self.keep
+        write_file(self.filename, ''.join(
+            '%s %s %f\n' % (item, service, when)
+            for (item, service), when in sorted(sent.items(), key=lambda s: s[1]) if when > cutoff))
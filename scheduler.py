@@ -0,0 +1,128 @@
+#!/usr/bin/env python
+#
+# scheduler.py:
+# Run every bot in one go, in this process or across a pool of workers
+#
+# Copyright (c) 2018 Matthew Somerville.
+# http://www.dracos.co.uk/
+#
+# A bot module is one with a top-level bots(argv) function returning its
+# bots, found by reading the source rather than importing it. Modules are
+# imported and their bots made once per process, and each bot then runs on
+# its own, so one that fails is logged and the rest carry on.
+#
+#   scheduler.py post [--workers N] [--bots NAME ...] [--timings] [bot options]
+
+import argparse
+import ast
+import glob
+import importlib
+import logging
+import os
+import sys
+import time
+import traceback
+from concurrent.futures import ProcessPoolExecutor
+from bot import SchedulerBot
+
+DIRECTORY = os.path.dirname(os.path.abspath(__file__))
+BOTS = {}  # (module, bot name) to bot, made once in each process
+
+log = logging.getLogger(__name__)
+
+
+def discover(directory=DIRECTORY):
+    """Return the names of the modules in directory that define bots()."""
+    found = []
+    for filename in sorted(glob.glob(os.path.join(directory, '*.py'))):
+        try:
+            tree = ast.parse(open(filename, 'rb').read(), filename)
+        except (SyntaxError, ValueError):
+            continue
+        if any(isinstance(node, ast.FunctionDef) and node.name == 'bots' for node in tree.body):
+            found.append(os.path.splitext(os.path.basename(filename))[0])
+    return found
+
+
+def load(modules, argv):
+    """Import modules and make their bots, skipping any module that fails or
+    has no bot taking the action. Returns the keys of the bots made."""
+    for name in modules:
+        try:
+            module = importlib.import_module(name)
+            classes = [c for c in vars(module).values()
+                       if isinstance(c, type) and issubclass(c, SchedulerBot) and c.__module__ == name]
+            if not any(argv[0] in c.choices for c in classes):
+                continue
+            for bot in module.bots(argv):
+                BOTS[(name, bot.name)] = bot
+        except (Exception, SystemExit):
+            log.exception('Could not load bots from %s' % name)
+    return list(BOTS)
+
+
+def run(key):
+    """Run one bot, returning (key, seconds taken, error or None, timings)."""
+    bot = BOTS[key]
+    start = time.time()
+    error = None
+    try:
+        bot.run()
+    except (Exception, SystemExit):
+        error = traceback.format_exc()
+    return key, time.time() - start, error, bot.last_timings
+
+
+def report(results, taken):
+    print('%-24s %10s  %s' % ('bot', 'seconds', 'phases'))
+    phases = {}
+    for (module, name), seconds, error, timings in results:
+        mine = {}
+        for timing in timings:
+            mine[timing['phase']] = mine.get(timing['phase'], 0) + timing['seconds']
+            phases[timing['phase']] = phases.get(timing['phase'], 0) + timing['seconds']
+        detail = ', '.join('%s %.3f' % p for p in sorted(mine.items()))
+        print('%-24s %10.3f  %s%s' % ('%s/%s' % (module, name), seconds, 'FAILED ' if error else '', detail))
+    print('%-24s %10.3f  %s' % ('all %d bots' % len(results), taken,
+                                ', '.join('%s %.3f' % p for p in sorted(phases.items()))))
+
+
+def main():
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s [%(levelname)s] %(module)s: %(message)s')
+    p = argparse.ArgumentParser(description='Run an action for every bot; other options are passed to the bots.')
+    p.add_argument('action', help='Action to perform, as for each bot')
+    p.add_argument('--workers', type=int, default=0, metavar='N',
+                   help='Run the bots across N worker processes, rather than one after another in this one')
+    p.add_argument('--bots', nargs='+', metavar='NAME', help='Only run these bots, or the bots of these modules')
+    p.add_argument('--timings', action='store_true', help='Print how long each bot and each phase took')
+    args, left = p.parse_known_args()
+    argv = [args.action] + left
+    modules = discover()
+
+    start = time.time()
+    keys = [key for key in load(modules, argv) if not args.bots or key[0] in args.bots or key[1] in args.bots]
+    if args.action == 'serve':
+        # Serving never finishes, so every bot needs a process of its own
+        args.workers = max(args.workers, len(keys))
+    if args.workers and keys:
+        with ProcessPoolExecutor(args.workers, initializer=load, initargs=(modules, argv)) as pool:
+            futures = [(key, pool.submit(run, key)) for key in keys]
+            results = []
+            for key, future in futures:
+                try:
+                    results.append(future.result())
+                except Exception:
+                    results.append((key, 0, traceback.format_exc(), []))
+    else:
+        results = [run(key) for key in keys]
+
+    for (module, name), seconds, error, timings in results:
+        if error:
+            log.error('%s/%s failed:\n%s' % (module, name, error))
+    if args.timings:
+        report(results, time.time() - start)
+    return 1 if any(r[2] for r in results) else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,100 @@
+#!/usr/bin/env python
+#
+# store.py:
+# Every bot's upcoming events, in one SQLite database
+#
+# Copyright (c) 2018 Matthew Somerville.
+# http://www.dracos.co.uk/
+
+import sqlite3
+import sys
+import threading
+import time
+
+TABLES = ('events', 'overrides')
+
+# Whether bot %s has a hand-edited schedule in use
+OVERRIDDEN = "EXISTS (SELECT 1 FROM sources WHERE sources.bot=%s AND tab='overrides' AND key IS NOT NULL)"
+
+SCHEMA = '''
+CREATE TABLE IF NOT EXISTS %(table)s (
+    bot TEXT NOT NULL,
+    epoch INTEGER NOT NULL,
+    summary TEXT,
+    event BLOB NOT NULL
+);
+CREATE INDEX IF NOT EXISTS %(table)s_bot_epoch ON %(table)s (bot, epoch);
+'''
+
+
+class EventStore(object):
+    """Events parsed from each bot's schedule, indexed by bot and time. Each
+    table records in sources what the rows were parsed from, so a bot only
+    re-parses when that changes. While a bot has a key for overrides, from
+    a hand-edited schedule, its rows there are used instead of those in
+    events, even if there are none."""
+
+    def __init__(self, filename):
+        self.db = sqlite3.connect(filename, timeout=30, isolation_level=None, check_same_thread=False)
+        self.lock = threading.Lock()
+        with self.lock:
+            self.db.execute('PRAGMA journal_mode=WAL')
+            self.db.execute('PRAGMA synchronous=NORMAL')
+            for table in TABLES:
+                self.db.executescript(SCHEMA % {'table': table})
+            self.db.execute('CREATE TABLE IF NOT EXISTS sources ('
+                            'bot TEXT NOT NULL, tab TEXT NOT NULL, key TEXT, PRIMARY KEY (bot, tab))')
+
+    def key(self, bot, table):
+        with self.lock:
+            row = self.db.execute('SELECT key FROM sources WHERE bot=? AND tab=?', (bot, table)).fetchone()
+        return row and row[0]
+
+    def set_key(self, bot, table, key):
+        with self.lock:
+            self.db.execute('UPDATE sources SET key=? WHERE bot=? AND tab=?', (key, bot, table))
+
+    def replace(self, bot, table, key, rows):
+        """Replace bot's rows in table with rows, (epoch, summary, event) tuples."""
+        with self.lock:
+            with self.db:
+                self.db.execute('BEGIN IMMEDIATE')
+                self.db.execute('DELETE FROM %s WHERE bot=?' % table, (bot,))
+                self.db.executemany('INSERT INTO %s (bot, epoch, summary, event) VALUES (?, ?, ?, ?)' % table,
+                                    ((bot,) + tuple(row) for row in rows))
+                self.db.execute('INSERT OR REPLACE INTO sources (bot, tab, key) VALUES (?, ?, ?)',
+                                (bot, table, key))
+
+    def clear(self, bot, table):
+        self.replace(bot, table, None, [])
+
+    def between(self, bot, start=None, end=None):
+        """Return bot's (epoch, event) rows with start < epoch <= end, in order."""
+        start = -2 ** 63 if start is None else start
+        end = 2 ** 63 - 1 if end is None else end
+        with self.lock:
+            return self.db.execute(
+                'SELECT epoch, event FROM overrides WHERE bot=? AND epoch>? AND epoch<=? '
+                'UNION ALL '
+                'SELECT epoch, event FROM events WHERE bot=? AND epoch>? AND epoch<=? '
+                'AND NOT ' + OVERRIDDEN % '?' + ' '
+                'ORDER BY epoch', (bot, start, end, bot, start, end, bot)).fetchall()
+
+    def upcoming(self, start, end=None):
+        """Return (bot, epoch, summary) rows of every bot's events after start."""
+        end = 2 ** 63 - 1 if end is None else end
+        with self.lock:
+            return self.db.execute(
+                'SELECT bot, epoch, summary FROM overrides WHERE epoch>? AND epoch<=? '
+                'UNION ALL '
+                'SELECT bot, epoch, summary FROM events WHERE epoch>? AND epoch<=? '
+                'AND NOT ' + OVERRIDDEN % 'events.bot' + ' '
+                'ORDER BY epoch', (start, end, start, end)).fetchall()
+
+
+if __name__ == '__main__':
+    # List what every bot has coming up
+    from bot import SchedulerBot
+    store = EventStore(sys.argv[1] if len(sys.argv) > 1 else SchedulerBot.storefile)
+    for bot, epoch, summary in store.upcoming(time.time()):
+        print('%s %s %s' % (time.strftime('%Y-%m-%d %H:%M', time.localtime(epoch)), bot, summary))